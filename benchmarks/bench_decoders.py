@@ -0,0 +1,266 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" Decoder micro-benchmarks. Runs offline: frames of realistic size are
+generated for every supported frame type (and, optionally, taken from
+recordings made with bleakheart.Recorder), and each decoder is timed and
+its memory allocations measured. The results are written as a JSON report,
+which can be compared with the report of another version:
+
+    python benchmarks/bench_decoders.py -o new.json --compare old.json
+
+The exit status is 1 if any decoder is slower than in the compared report
+by more than the threshold. """
+
+import sys
+import json
+import math
+import random
+import argparse
+import platform
+import timeit
+import tracemalloc
+from collections import defaultdict
+import bleakheart
+from bleakheart import HeartRate, PolarMeasurementData, read_recording
+from bleakheart._simulator import _encode_delta_frame
+try:
+    import numpy as np
+except ImportError:
+    np=None
+
+
+# a compressed PPG frame from a Polar Verity (see _decode_delta_frame)
+VERITY_PPG=bytes.fromhex(
+    "012d3bbaacab31180b80bb1af87d9bf894b9f8df20f6082acbead5e200d2de2c"
+    "ccdab6eef5d5f91117faf1efbf99caa7ec05e24ce2dfe3fe19316636e80ed6c2"
+    "39cbf627da2f2c1124ced8e2ec3e0d211e0ff1ddd38e192df93fbea30708f330"
+    "11ee1e32cd0611d81112e01419c905001d39f8e9978fbbea14f9db0e1c2528fe"
+    "c7cbd50034fc11feee16ff18deecd007e3dbed175a3d66dbc5dc06f1301a9b1a"
+    "03345f1cebf0fbc90f16fc3b183bda1c1fd519d11111de08f5292afafc0f20e3"
+    "0a070374af4101f2f7d0bffc3510e0c3fc2b883100030b5cbfc2012b20418004"
+    "0d3850c3fc")
+
+
+def pmd_frame(measurement, frametype, payload):
+    """ A PMD data frame with a fixed time stamp """
+    mtype=PolarMeasurementData.measurement_types.index(measurement)
+    return (bytearray([mtype])+(10**18).to_bytes(8, 'little')+
+            bytearray([frametype])+payload)
+
+
+def random_walk(rng, count, channels, step, start=0):
+    """ Samples following a random walk, so that deltas stay small as in
+    real signals """
+    values=[start]*channels
+    samples=[]
+    for _ in range(count):
+        values=[v+rng.randint(-step, step) for v in values]
+        samples.append(values if channels>1 else values[0])
+    return samples
+
+
+def raw_payload(samples, size):
+    data=bytearray()
+    for sample in samples:
+        for v in (sample if isinstance(sample, list) else [sample]):
+            data+=v.to_bytes(size, 'little', signed=True)
+    return data
+
+
+def synthetic_frames():
+    """ Frames of realistic size for each supported frame type.
+
+    Returns:
+        A list of (name, measurement, frame) tuples; measurement is 'HR'
+        for heart rate frames
+    """
+    rng=random.Random(0)
+    frames=[]
+    # uncompressed frames: H10 ECG (73 samples), ACC (36 samples), PPG
+    sizes=PolarMeasurementData.raw_frame_sizes
+    counts={'ECG': 73, 'ACC': 36, 'PPG': 35}
+    for (meas, ftype), size in sizes.items():
+        channels=PolarMeasurementData.sample_channels[meas]
+        step=min(2**(8*size-2)//64, 50)
+        samples=random_walk(rng, counts[meas], channels, step)
+        frames.append((f'{meas} raw {ftype:#04x}', meas,
+                       pmd_frame(meas, ftype, raw_payload(samples, size))))
+    # compressed frames, with the default settings
+    for meas, count, step in (('ECG', 73, 20), ('PPG', 35, 200),
+                              ('ACC', 36, 20), ('GYRO', 36, 20),
+                              ('MAG', 20, 20)):
+        settings=PolarMeasurementData.default_settings.get(meas, {})
+        resolution=settings.get('RESOLUTION', 16)
+        channels=settings.get('CHANNELS',
+                              PolarMeasurementData.sample_channels[meas])
+        samples=random_walk(rng, count, channels, step)
+        frames.append((f'{meas} delta', meas, pmd_frame(
+            meas, 0x80, _encode_delta_frame(samples, resolution, channels))))
+    frames.append(('PPG delta (Verity)', 'PPG', bytearray(VERITY_PPG)))
+    # heart rate: one or two RR intervals, 16 bit rate, energy expenditure
+    for name, frame in (('HR 1 RR', [0x10, 60, 0x00, 0x04]),
+                        ('HR 2 RR', [0x10, 60, 0x00, 0x04, 0x10, 0x04]),
+                        ('HR 16 bit + energy', [0x19, 60, 0, 10, 0,
+                                                0x00, 0x04]),
+                        ('HR no RR', [0x00, 60])):
+        frames.append((name, 'HR', bytearray(frame)))
+    return frames
+
+
+def recorded_frames(path, limit=1000):
+    """ Frames from a recording, at most limit per measurement and frame
+    type. Compressed frames are decoded with the default settings. """
+    by_type=defaultdict(list)
+    for _, char, data in read_recording(path):
+        if char==HeartRate.CHARACTERISTIC:
+            key=('HR', None)
+        elif char==PolarMeasurementData.PMDDATAMTU:
+            key=(PolarMeasurementData.measurement_types[data[0]], data[9])
+        else:
+            continue
+        if len(by_type[key])<limit:
+            by_type[key].append(data)
+    frames=[]
+    for (meas, ftype), data in by_type.items():
+        suffix='' if ftype==None else f' {ftype:#04x}'
+        for frame in data:
+            frames.append((f'{meas}{suffix} ({path})', meas, frame))
+    return frames
+
+
+def decoders():
+    """ The decoders to benchmark, as (label, factory) pairs; factory
+    takes a measurement and frame type and returns a decoder or None """
+    def pmd_factory(use_numpy):
+        # with a callback, every measurement is decoded
+        pmd=PolarMeasurementData(None, callback=lambda frame: None,
+                                 use_numpy=use_numpy)
+        return lambda meas, ftype: (pmd._make_decoder(meas, ftype)
+                                    if meas!='HR' else None)
+    hr=HeartRate(None, callback=lambda frame: None)
+    result=[('list', pmd_factory(False)),
+            ('hr', lambda meas, ftype: hr._decode if meas=='HR' else None)]
+    if np!=None:
+        result.insert(1, ('numpy', pmd_factory(True)))
+    return result
+
+
+def count_samples(decoded):
+    if isinstance(decoded, tuple):
+        # heart rate record (hr, rr, energy, contact)
+        return max(len(decoded[1]), 1)
+    return len(decoded)
+
+
+def measure(decoder, frames, min_time):
+    """ Times decoder over frames, and measures its allocations.
+
+    Returns:
+        A dictionary with the time per frame and per sample in ns, the
+        peak memory allocated while decoding a frame and the memory held
+        by the result, in bytes (averaged over frames)
+    """
+    def run():
+        for frame in frames:
+            decoder(frame)
+    timer=timeit.Timer(run)
+    loops, elapsed=timer.autorange()
+    loops=max(math.ceil(loops*min_time/elapsed), 1)
+    best=min(timer.repeat(repeat=5, number=loops))/loops
+    samples=sum(count_samples(decoder(frame)) for frame in frames)
+    peak=held=0
+    tracemalloc.start()
+    for frame in frames:
+        tracemalloc.reset_peak()
+        before=tracemalloc.get_traced_memory()[0]
+        result=decoder(frame)
+        current, top=tracemalloc.get_traced_memory()
+        peak+=top-before
+        held+=current-before
+        del result
+    tracemalloc.stop()
+    return {'frames': len(frames),
+            'samples': samples,
+            'frame_bytes': sum(len(f) for f in frames)/len(frames),
+            'ns_per_frame': best*1e9/len(frames),
+            'ns_per_sample': best*1e9/samples,
+            'alloc_peak_bytes': peak/len(frames),
+            'alloc_result_bytes': held/len(frames)}
+
+
+def run_benchmarks(frames, min_time):
+    """ Benchmarks every decoder on every frame type it supports """
+    groups=defaultdict(list)
+    for name, meas, frame in frames:
+        groups[name, meas].append(frame)
+    results=[]
+    for label, factory in decoders():
+        for (name, meas), group in groups.items():
+            ftype=None if meas=='HR' else group[0][9]
+            decoder=factory(meas, ftype)
+            if decoder==None:
+                continue
+            result={'name': name, 'decoder': label}
+            result.update(measure(decoder, group, min_time))
+            results.append(result)
+            print(f"{name:32s} {label:6s} {result['ns_per_frame']:10.0f} "
+                  f"ns/frame {result['ns_per_sample']:8.1f} ns/sample "
+                  f"{result['alloc_peak_bytes']:8.0f} B peak", flush=True)
+    return results
+
+
+def compare(results, path, threshold):
+    """ Prints the ratio of each time per sample to that in the report at
+    path. Returns True if any ratio exceeds threshold. """
+    with open(path) as f:
+        old={(r['name'], r['decoder']): r for r in json.load(f)['results']}
+    regression=False
+    print(f"\nCompared with {path}:")
+    for r in results:
+        prev=old.get((r['name'], r['decoder']))
+        if prev==None:
+            continue
+        ratio=r['ns_per_sample']/prev['ns_per_sample']
+        flag=''
+        if ratio>threshold:
+            flag='  REGRESSION'
+            regression=True
+        print(f"{r['name']:32s} {r['decoder']:6s} {ratio:6.2f}x{flag}")
+    return regression
+
+
+def main():
+    parser=argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', default='bench_decoders.json',
+                        help="path of the JSON report")
+    parser.add_argument('-r', '--recording', action='append', default=[],
+                        help="also benchmark the frames of a recording")
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help="minimum time of each timing run, in s")
+    parser.add_argument('--compare', help="a previous report to compare with")
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help="slowdown ratio reported as a regression")
+    args=parser.parse_args()
+    frames=synthetic_frames()
+    for path in args.recording:
+        frames+=recorded_frames(path)
+    results=run_benchmarks(frames, args.min_time)
+    report={'bleakheart': bleakheart.__version__,
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'numpy': np.__version__ if np!=None else None,
+            'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f"Report written to {args.output}")
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__=="__main__":
+    main()
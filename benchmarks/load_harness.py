@@ -0,0 +1,237 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" End-to-end load harness. Runs increasing numbers of simulated devices
+(see bleakheart.SimulatedDevice) in a single event loop, each streaming
+heart rate and PMD measurements through HeartRate and
+PolarMeasurementData to a consumer task, and reports for each load level:
+
+- end-to-end latency, from notification to consumer, in ms
+- event loop lag (how late a periodic timer fires) percentiles, in ms
+- CPU use, frames/s and samples/s
+
+A load level is sustainable if the 99th percentile of the loop lag stays
+below --max-lag-ms, the consumers receive at least 95% of the frames sent
+and the CPU is not saturated. Since a single event loop runs on a single
+core, the largest sustainable level is the number of devices per core.
+The simulated devices generate their signals in the same loop, so this
+figure is conservative:
+
+    python benchmarks/load_harness.py --devices 10,50,100,200 -o load.json
+"""
+
+import json
+import time
+import asyncio
+import argparse
+import platform
+from collections import defaultdict, deque
+from time import time_ns
+import bleakheart
+from bleakheart import HeartRate, PolarMeasurementData, SimulatedDevice
+
+
+class TimedDevice(SimulatedDevice):
+    """ A SimulatedDevice that notes the time of each data notification,
+    so that the latency to the consumer can be measured. Every
+    notification yields exactly one frame (heart rate is not unpacked), so
+    frames are matched to notifications in order. """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # notification times, by measurement
+        self.sent=defaultdict(deque)
+
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        char=str(char_specifier).lower()
+        if char==PolarMeasurementData.PMDCTRLPOINT.lower():
+            return await super().start_notify(char_specifier, callback)
+        types=PolarMeasurementData.measurement_types
+        async def timed(characteristic, data):
+            key='HR' if char==HeartRate.CHARACTERISTIC else types[data[0]]
+            self.sent[key].append(time_ns())
+            await callback(characteristic, data)
+        await super().start_notify(char_specifier, timed)
+
+
+class LevelStats:
+    """ Statistics collected at one load level """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.frames=0
+        self.samples=0
+        self.latency=[]  # ns
+        self.lag=[]      # ns
+
+
+def percentile(values, p):
+    """ The p-th percentile of values (nearest rank) """
+    if not values:
+        return None
+    values=sorted(values)
+    rank=min(max(round(p/100*len(values)+0.5)-1, 0), len(values)-1)
+    return values[rank]
+
+
+def busy_wait(ns):
+    """ Simulates CPU work in the consumer """
+    end=time.perf_counter_ns()+ns
+    while time.perf_counter_ns()<end:
+        pass
+
+
+async def consume(device, queue, stats, work_ns):
+    """ Consumer task: takes frames off the queue, measures latency """
+    while True:
+        frame=await queue.get()
+        now=time_ns()
+        stats.latency.append(now-device.sent[frame[0]].popleft())
+        stats.frames+=1
+        stats.samples+=1 if frame[0]=='HR' else len(frame[2])
+        if work_ns:
+            busy_wait(work_ns)
+
+
+async def monitor_lag(stats, interval):
+    """ Measures how late a timer of the given interval (s) fires """
+    loop=asyncio.get_running_loop()
+    while True:
+        expected=loop.time()+interval
+        await asyncio.sleep(interval)
+        stats.lag.append(round((loop.time()-expected)*1e9))
+
+
+def expected_frame_rate(device, measurements):
+    """ Frames per second sent by a device """
+    rate=1.0 # heart rate
+    for meas in measurements:
+        settings=device.capabilities[meas]
+        rate+=settings['SAMPLE_RATE'][0]/device.frame_samples[meas]
+    return rate
+
+
+async def run_level(n, args):
+    """ Runs n devices for args.duration seconds, after a warm-up """
+    stats=LevelStats()
+    devices=[TimedDevice(address=f'SIM{i:04d}', seed=i,
+                         compressed=args.compressed)
+             for i in range(n)]
+    tasks=[]
+    loop=asyncio.get_running_loop()
+    start=loop.time()
+    for i, device in enumerate(devices):
+        # real devices are not in phase: spread the starts over a second
+        await asyncio.sleep(max(start+i/n-loop.time(), 0))
+        queue=asyncio.Queue()
+        pmd=PolarMeasurementData(device, callback=queue.put_nowait,
+                                 use_numpy=args.numpy)
+        hr=HeartRate(device, queue=queue, unpack=False)
+        tasks.append(asyncio.ensure_future(
+            consume(device, queue, stats, args.work_us*1000)))
+        for meas in args.measurements:
+            code, msg=(await pmd.start_streaming(meas))[:2]
+            if code!=0:
+                raise RuntimeError(f"Could not start {meas}: {msg}")
+        await hr.start_notify()
+    tasks.append(asyncio.ensure_future(monitor_lag(stats,
+                                                   args.lag_interval_ms/1000)))
+    await asyncio.sleep(args.warmup)
+    stats.reset()
+    cpu=time.process_time()
+    wall=time.perf_counter()
+    await asyncio.sleep(args.duration)
+    cpu=time.process_time()-cpu
+    wall=time.perf_counter()-wall
+    for device in devices:
+        await device.disconnect()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    expected=n*expected_frame_rate(devices[0], args.measurements)*wall
+    ms=lambda ns: ns/1e6 if ns!=None else None
+    result={'devices': n,
+            'frames_per_s': stats.frames/wall,
+            'samples_per_s': stats.samples/wall,
+            'delivered': stats.frames/expected,
+            'cpu': cpu/wall,
+            'latency_ms': {f'p{p}': ms(percentile(stats.latency, p))
+                           for p in (50, 95, 99, 100)},
+            'lag_ms': {f'p{p}': ms(percentile(stats.lag, p))
+                       for p in (50, 95, 99, 100)}}
+    result['sustainable']=(result['lag_ms']['p99']!=None and
+                           result['lag_ms']['p99']<=args.max_lag_ms and
+                           result['delivered']>=0.95 and
+                           result['cpu']<args.max_cpu)
+    return result
+
+
+async def main(args):
+    results=[]
+    best=0
+    print(" devices   frames/s  samples/s   cpu  latency p50/p99 ms"
+          "   lag p50/p99/max ms")
+    for n in args.devices:
+        result=await run_level(n, args)
+        results.append(result)
+        lat, lag=result['latency_ms'], result['lag_ms']
+        print(f"{n:8d} {result['frames_per_s']:10.0f} "
+              f"{result['samples_per_s']:10.0f} {result['cpu']:5.0%} "
+              f"{lat['p50']:8.2f} {lat['p99']:8.2f}   "
+              f"{lag['p50']:6.2f} {lag['p99']:6.2f} {lag['p100']:6.2f}"
+              f"{'' if result['sustainable'] else '  (not sustainable)'}",
+              flush=True)
+        if not result['sustainable']:
+            break
+        best=n
+    print(f"Maximum sustainable devices per core: {best}"
+          +(" (or more)" if best==args.devices[-1] else ""))
+    if args.output:
+        report={'bleakheart': bleakheart.__version__,
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'measurements': args.measurements,
+                'compressed': args.compressed,
+                'numpy': args.numpy,
+                'work_us': args.work_us,
+                'max_devices_per_core': best,
+                'results': results}
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+        print(f"Report written to {args.output}")
+
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', default='10,25,50,100,200,400,800',
+                        help="comma separated device counts, in increasing "
+                        "order; the ramp stops at the first level that is "
+                        "not sustainable")
+    parser.add_argument('--measurements', default='ECG,ACC',
+                        help="PMD measurements streamed by each device, in "
+                        "addition to heart rate (ECG, ACC, PPG)")
+    parser.add_argument('--compressed', default='',
+                        help="measurements sent as compressed frames")
+    parser.add_argument('--numpy', action='store_true',
+                        help="decode frames into numpy arrays")
+    parser.add_argument('--work-us', type=float, default=0,
+                        help="CPU time spent by the consumer on each frame")
+    parser.add_argument('--duration', type=float, default=10,
+                        help="measurement time per level, in s")
+    parser.add_argument('--warmup', type=float, default=2,
+                        help="warm-up time per level, in s")
+    parser.add_argument('--lag-interval-ms', type=float, default=10)
+    parser.add_argument('--max-lag-ms', type=float, default=50,
+                        help="sustainable 99th percentile of the loop lag")
+    parser.add_argument('--max-cpu', type=float, default=0.9,
+                        help="sustainable fraction of a core")
+    parser.add_argument('-o', '--output', help="path of a JSON report")
+    args=parser.parse_args()
+    args.devices=[int(n) for n in args.devices.split(',')]
+    args.measurements=[m for m in args.measurements.split(',') if m]
+    args.compressed=[m for m in args.compressed.split(',') if m]
+    asyncio.run(main(args))
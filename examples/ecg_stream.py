@@ -0,0 +1,55 @@
+"""
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+""" ECG acquisition using the asynchronous iterator interface. Compare
+with ecg_queue.py: there is no queue to set up, no QUIT sentinel, and the
+consumer loop only wakes up once per batch. """
+
+import sys
+import asyncio
+from contextlib import aclosing
+from bleak import BleakScanner, BleakClient
+from bleakheart import PolarMeasurementData
+
+# number of ECG samples to print per batch
+PRINT_SAMPLES = 5
+
+
+async def scan():
+    """ Scan for a Polar device. """
+    device= await BleakScanner.find_device_by_filter(
+        lambda dev, adv: dev.name and "polar" in dev.name.lower())
+    return device
+
+
+async def main():
+    print("Scanning for BLE devices")
+    device=await scan()
+    if device==None:
+        print("Polar device not found.")
+        sys.exit(-4)
+    print(f"Connecting to {device}...")
+    async with BleakClient(device) as client:
+        pmd=PolarMeasurementData(client)
+        print("Will print one line per second of ECG data, in the form")
+        print("  tstamp frames samples [s1,s2,...]")
+        print("where tstamp (in ns) refers to the last frame of the batch.")
+        print(">>> Hit Ctrl-C to exit, or disconnect the sensor <<<")
+        # streaming starts with the iteration, and stops when it ends:
+        # either when the sensor disconnects, or when we break out of the
+        # loop (aclosing makes that immediate)
+        async with aclosing(pmd.stream('ECG', max_latency=1)) as batches:
+            async for batch in batches:
+                print(batch.tstamps[-1], len(batch.counts),
+                      len(batch.samples), batch.samples[:PRINT_SAMPLES])
+    print("Bye.")
+
+
+# execute the main coroutine
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    pass
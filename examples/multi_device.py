@@ -0,0 +1,87 @@
+"""
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+""" Heart rate and ECG acquisition from all the Polar devices in range,
+using a SessionManager. Data from all devices arrive on the same queue,
+tagged with the device address. Devices that drop out are reconnected,
+and their streams restored. Run with --simulate to use simulated devices
+instead. """
+
+import sys
+import asyncio
+from bleak import BleakScanner, BleakClient
+from bleakheart import SessionManager, SimulatedDevice
+
+# seconds between throughput reports
+REPORT_INTERVAL = 5
+
+
+async def scan():
+    """ Scan for Polar devices. """
+    devices=await BleakScanner.discover()
+    return [dev for dev in devices if dev.name and "polar" in
+            dev.name.lower()]
+
+
+async def report(manager):
+    """ Print the throughput of each device periodically """
+    while True:
+        await asyncio.sleep(REPORT_INTERVAL)
+        for address, stats in manager.stats().items():
+            status=('connected' if stats.connected
+                    else f'disconnected ({stats.error})')
+            print(f"{address}: {stats.frames_per_s:.1f} frames/s "
+                  f"{stats.samples_per_s:.1f} samples/s, {status}")
+
+
+def outage(outage):
+    """ Called when a device has been reconnected (or given up on) """
+    if outage.restored==None:
+        print(f"{outage.address}: could not reconnect ({outage.errors})")
+    elif outage.gap_s==None:
+        print(f"{outage.address}: reconnected, but no data yet "
+              f"({outage.attempts} attempts)")
+    else:
+        print(f"{outage.address}: reconnected, data gap {outage.gap_s:.1f} s "
+              f"({outage.attempts} attempts)")
+
+
+async def main(simulate):
+    if simulate:
+        devices=[f'SIM{i}' for i in range(4)]
+        factory=lambda device, **kwargs: SimulatedDevice(device, **kwargs)
+    else:
+        print("Scanning for BLE devices")
+        devices=await scan()
+        factory=BleakClient
+        if not devices:
+            print("No Polar devices found.")
+            sys.exit(-4)
+    queue=asyncio.Queue()
+    manager=SessionManager(devices, {'HR': {}, 'ECG': {}}, queue=queue,
+                           client_factory=factory,
+                           reconnect={'callback': outage, 'max_backoff': 5})
+    print(f"Connecting to {len(devices)} device(s)...")
+    async with manager:
+        started=[address for address, stats in manager.stats().items()
+                 if stats.connected]
+        print(f"Streaming from {started}")
+        print(">>> Hit Ctrl-C to exit <<<")
+        reporter=asyncio.ensure_future(report(manager))
+        try:
+            while True:
+                address, frame=await queue.get()
+                if frame[0]=='HR':
+                    print(address, frame)
+        finally:
+            reporter.cancel()
+
+
+# execute the main coroutine
+try:
+    asyncio.run(main('--simulate' in sys.argv))
+except KeyboardInterrupt:
+    pass
@@ -6,7 +6,12 @@ An asynchronous BLE Heart Monitor library with support for additional data
 from Polar monitors (ECG, accelerometers, PPG)
 """
 
-__all__=['BatteryLevel', 'HeartRate', 'PolarMeasurementData']
+__all__=['BatteryLevel', 'HeartRate', 'PolarMeasurementData', 'FrameBatch',
+         'RingBuffer', 'BoundedQueue', 'ClockSync', 'sample_timestamps',
+         'Recorder', 'read_recording',
+         'ReplayClient', 'ReplayStats', 'SimulatedDevice',
+         'SessionManager', 'DeviceStats', 'Supervisor', 'Outage',
+         'CapabilityCache', 'Metrics', 'StreamSnapshot', 'Histogram']
 
 __copyright__= "Copyright (C) F. Smeraldi <fabrizio@smeraldi.net> 2023,25"
 __license__= "Mozilla Public License Version 2.0"
@@ -16,3 +21,12 @@ __uri__= "https://github.com/fsmeraldi/bleakheart"
 
 from ._version import __version__
 from ._core import BatteryLevel, HeartRate, PolarMeasurementData
+from ._batching import FrameBatch
+from ._sinks import RingBuffer, BoundedQueue
+from ._timing import ClockSync, sample_timestamps
+from ._recording import (Recorder, read_recording, ReplayClient,
+                         ReplayStats)
+from ._simulator import SimulatedDevice
+from ._cache import CapabilityCache
+from ._metrics import Metrics, StreamSnapshot, Histogram
+from ._session import SessionManager, DeviceStats, Supervisor, Outage
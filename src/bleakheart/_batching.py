@@ -0,0 +1,175 @@
+"""
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+import asyncio as aio
+from collections import namedtuple
+from itertools import chain
+from inspect import iscoroutinefunction
+# numpy is optional; batches of arrays are only built if it is installed
+try:
+    import numpy as np
+except ImportError:
+    np=None
+
+
+FrameBatch=namedtuple('FrameBatch', ['measurement', 'tstamps', 'samples',
+                                     'counts'])
+FrameBatch.__doc__=""" A batch of frames for a single measurement, as
+delivered in batching mode. Like ordinary frames, batches are tuples whose
+first element is the measurement type.
+
+measurement: the measurement type ('HR', 'ECG', 'ACC'...)
+tstamps:     a list with the time stamp (in ns) of each frame or, with
+             per-sample time stamps, an array with that of each sample
+samples:     the samples of all frames, concatenated (a list, or a numpy
+             array for arrays decoded with use_numpy=True). For heart rate,
+             one (hr, rr) item per frame or heartbeat
+counts:      a list with the number of samples contributed by each frame
+"""
+
+
+class FrameBatcher:
+    """ Accumulates the frames of one measurement and passes them on as a
+    single FrameBatch every max_frames frames, or max_ms milliseconds
+    after the first frame of the batch was received, whichever comes
+    first. The put coroutine takes the place of the queue or callback that
+    frames would otherwise be sent to. Batches rejected by a full queue 
+    are dropped, and their frames counted in the dropped attribute. """
+
+    def __init__(self, measurement, callback, max_frames=None, max_ms=None,
+                 frame_is_sample=False):
+        """ Init the batcher.
+
+        Args:
+
+        measurement: the measurement type, used to tag batches
+        callback:    a function or coroutine function to which batches
+                     are passed (e.g. the put_nowait method of a queue)
+        max_frames:  maximum number of frames in a batch
+        max_ms:      maximum time in milliseconds a frame is held back
+        frame_is_sample: if True, the payload of each frame is a single
+                     sample (as for heart rate), rather than a list of
+                     samples
+        """
+        if max_frames==None and max_ms==None:
+            raise ValueError("Batching requires max_frames or max_ms")
+        self.measurement=measurement
+        self.max_frames=max_frames
+        self.max_ms=max_ms
+        self._callback=callback
+        self._callback_is_coro=iscoroutinefunction(callback)
+        self._frame_is_sample=frame_is_sample
+        self._tstamps=[]
+        self._samples=[]
+        self._timer=None
+        # frames in batches rejected by a full queue
+        self.dropped=0
+        # task delivering a batch flushed by the timer to a coroutine;
+        # awaited before the next delivery to preserve ordering
+        self._pending=None
+
+    async def put(self, frame):
+        """ Adds a (MEAS, tstamp, payload, ...) frame to the batch; passes
+        the batch on if it is full """
+        self._tstamps.append(frame[1])
+        self._samples.append([frame[2]] if self._frame_is_sample
+                             else frame[2])
+        if (self.max_frames!=None and
+            len(self._tstamps)>=self.max_frames):
+            await self.flush()
+        elif self._timer==None and self.max_ms!=None:
+            loop=aio.get_running_loop()
+            self._timer=loop.call_later(self.max_ms/1000, self._on_timer)
+
+    async def flush(self):
+        """ Passes on any frames received so far as a batch """
+        if self._pending!=None:
+            await self._pending
+            self._pending=None
+        batch=self._take()
+        if batch==None:
+            return
+        try:
+            if self._callback_is_coro:
+                await self._callback(batch)
+            else:
+                self._callback(batch)
+        except aio.QueueFull:
+            self.dropped+=len(batch.counts)
+
+    def _take(self):
+        """ Builds a batch from the accumulated frames and resets the
+        batcher. Returns None if there are no frames. """
+        if self._timer!=None:
+            self._timer.cancel()
+            self._timer=None
+        if len(self._tstamps)==0:
+            return None
+        counts=[len(s) for s in self._samples]
+        if np!=None and isinstance(self._samples[0], np.ndarray):
+            samples=np.concatenate(self._samples)
+        else:
+            samples=list(chain.from_iterable(self._samples))
+        tstamps=self._tstamps
+        if np!=None and isinstance(tstamps[0], np.ndarray):
+            tstamps=np.concatenate(tstamps)
+        batch=FrameBatch(self.measurement, tstamps, samples, counts)
+        self._tstamps=[]
+        self._samples=[]
+        return batch
+
+    def _on_timer(self):
+        """ Called by the event loop when max_ms has elapsed """
+        self._timer=None
+        batch=self._take()
+        if batch==None:
+            return
+        if self._callback_is_coro:
+            self._pending=aio.ensure_future(self._deliver(self._pending,
+                                                          batch))
+        else:
+            # called by the event loop: nobody else can count the drop
+            try:
+                self._callback(batch)
+            except aio.QueueFull:
+                self.dropped+=len(batch.counts)
+
+    async def _deliver(self, previous, batch):
+        """ Awaits delivery of the previous batch, then of this one """
+        if previous!=None:
+            await previous
+        try:
+            await self._callback(batch)
+        except aio.QueueFull:
+            self.dropped+=len(batch.counts)
+
+
+async def _watch_connection(client, queue, poll):
+    """ Puts None on the queue when the client disconnects """
+    while client.is_connected:
+        await aio.sleep(poll)
+    queue.put_nowait(None)
+
+
+async def _stream_batches(client, queue, batcher, poll=1.0):
+    """ Yields the batches that batcher puts on queue, until the client 
+    disconnects; then yields any batches left and returns. The connection 
+    is polled every poll seconds, so that the consumer only awaits the 
+    queue. """
+    watch=aio.ensure_future(_watch_connection(client, queue, poll))
+    try:
+        while True:
+            batch=await queue.get()
+            if batch==None:
+                break
+            yield batch
+        await batcher.flush()
+        while not queue.empty():
+            batch=queue.get_nowait()
+            if batch!=None:
+                yield batch
+    finally:
+        watch.cancel()
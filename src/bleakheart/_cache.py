@@ -0,0 +1,134 @@
+"""
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+import os
+import json
+import asyncio as aio
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+
+class CapabilityCache:
+    """ Caches the measurements available from each device and the
+    settings available for each measurement, by device address, so that
+    PolarMeasurementData.available_measurements and available_settings do
+    not query the device again, e.g. after a reconnection or when starting
+    several streams or devices. Pass the same CapabilityCache to the
+    PolarMeasurementData objects of all devices.
+
+    Entries can expire after a time to live, and the cache can be
+    persisted to a JSON file, so that it is shared by successive runs.
+    The file is rewritten whenever an entry is added, by a dedicated
+    thread, so that the event loop is not blocked.
+
+    The cache is an asynchronous context manager; otherwise, await
+    close() when done, so that the last entries are written out.
+    """
+
+    def __init__(self, path=None, ttl=None):
+        """ Init the cache, loading the file at path if it exists.
+
+        Args:
+
+        path: a JSON file in which the cache is persisted; if None, the
+              cache is in memory only
+        ttl:  time to live of the entries, in seconds; if None, entries
+              do not expire (use invalidate after a firmware update)
+        """
+        self.path=path
+        self.ttl=ttl
+        # address -> {'measurements': entry, 'settings': {meas: entry}},
+        # where entry is {'time': Epoch time in s, 'value': value}
+        self._entries={}
+        if path!=None and os.path.exists(path):
+            with open(path) as f:
+                self._entries=json.load(f)
+        # a single thread writes the file, in order
+        self._executor=(ThreadPoolExecutor(max_workers=1) if path!=None
+                        else None)
+        self._write_future=None
+
+    def _fresh(self, entry):
+        if entry==None:
+            return None
+        if self.ttl!=None and time()-entry['time']>self.ttl:
+            return None
+        return entry['value']
+
+    def get_measurements(self, address):
+        """ Returns the cached list of measurements available from the
+        device, or None """
+        return self._fresh(self._entries.get(address, {}).get('measurements'))
+
+    def put_measurements(self, address, measurements):
+        """ Caches the list of measurements available from the device """
+        device=self._entries.setdefault(address, {})
+        device['measurements']={'time': time(), 'value': list(measurements)}
+        self._submit()
+
+    def get_settings(self, address, measurement):
+        """ Returns the cached settings available for the measurement, as
+        a dictionary with a list of allowed values for each setting, or
+        None """
+        settings=self._entries.get(address, {}).get('settings', {})
+        return self._fresh(settings.get(measurement))
+
+    def put_settings(self, address, measurement, settings):
+        """ Caches the settings available for the measurement, given as a
+        dictionary with a list of allowed values for each setting """
+        device=self._entries.setdefault(address, {})
+        value={name: list(values) for name, values in settings.items()}
+        device.setdefault('settings', {})[measurement]={'time': time(),
+                                                        'value': value}
+        self._submit()
+
+    def invalidate(self, address=None):
+        """ Discards the entries of the device at address, or all entries
+        if address is None """
+        if address==None:
+            self._entries.clear()
+        else:
+            self._entries.pop(address, None)
+        self._submit()
+
+    def _submit(self):
+        """ Hands a copy of the entries over to the writer thread """
+        if self.path==None:
+            return
+        text=json.dumps(self._entries, indent=1)
+        self._write_future=self._executor.submit(self._write, text)
+
+    def _write(self, text):
+        """ Runs in the writer thread. The file is replaced atomically,
+        so that it is never left half written """
+        tmp=f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, self.path)
+
+    def save(self):
+        """ Writes the cache to its file, if any, and waits for the write
+        to complete. Blocks: use flush in the event loop """
+        self._submit()
+        if self._write_future!=None:
+            self._write_future.result()
+
+    async def flush(self):
+        """ Waits for the entries added so far to be written out """
+        if self._write_future!=None:
+            await aio.wrap_future(self._write_future)
+
+    async def close(self):
+        """ Writes out all entries and stops the writer thread """
+        await self.flush()
+        if self._executor!=None:
+            self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
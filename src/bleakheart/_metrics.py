@@ -0,0 +1,192 @@
+"""
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+import asyncio as aio
+from collections import namedtuple
+from inspect import iscoroutinefunction
+from time import perf_counter_ns
+
+
+StreamSnapshot=namedtuple('StreamSnapshot', [
+    'frames', 'samples', 'seconds', 'frames_per_s', 'samples_per_s',
+    'decode', 'callback', 'queue_depth', 'dropped', 'gaps', 'gap_s'])
+StreamSnapshot.__doc__=""" Health of one stream since the previous reset
+(or since metrics started): the number of frames and samples, the time in
+seconds they were counted over and the resulting rates, Histograms of the
+decode time and of the time taken by the queue or callback (in ns), the
+current number of items in the queue (None with a callback), the number
+of frames dropped so far, and the number and total length in seconds of
+the gaps detected in the time stamps. """
+
+
+class Histogram:
+    """ Histogram of durations in ns, with power-of-two buckets: bucket i
+    counts the durations d with 2**(i-1) <= d < 2**i. Recording a
+    duration is O(1). """
+
+    def __init__(self):
+        self.counts=[0]*64
+        self.count=0
+        self.total=0
+        self.max=0
+
+    def record(self, ns):
+        """ Adds a duration, in ns """
+        self.counts[ns.bit_length()]+=1
+        self.count+=1
+        self.total+=ns
+        if ns>self.max:
+            self.max=ns
+
+    @property
+    def mean(self):
+        """ The mean duration in ns, or None if empty """
+        return self.total/self.count if self.count else None
+
+    def percentile(self, p):
+        """ An upper bound for the p-th percentile, in ns (the upper edge
+        of its bucket, or the maximum if smaller), or None if empty """
+        if not self.count:
+            return None
+        rank=p/100*self.count
+        seen=0
+        for i, n in enumerate(self.counts):
+            seen+=n
+            if n and seen>=rank:
+                return min(2**i, self.max)
+        return self.max
+
+    def buckets(self):
+        """ Returns the non-empty buckets, as (upper edge in ns, count)
+        pairs """
+        return [(2**i, n) for i, n in enumerate(self.counts) if n]
+
+    def copy(self):
+        other=Histogram()
+        other.counts=self.counts.copy()
+        other.count, other.total, other.max=self.count, self.total, self.max
+        return other
+
+    def __repr__(self):
+        if not self.count:
+            return 'Histogram(count=0)'
+        return (f'Histogram(count={self.count}, mean={self.mean:.0f}, '
+                f'p50={self.percentile(50)}, p99={self.percentile(99)}, '
+                f'max={self.max})')
+
+
+class StreamMetrics:
+    """ Counters of one stream. Updated by HeartRate and
+    PolarMeasurementData; read them through Metrics.snapshot. """
+
+    def __init__(self):
+        # time stamp of the last frame, kept across resets
+        self.last_tstamp=None
+        self.reset()
+
+    def reset(self):
+        self.since=perf_counter_ns()
+        self.frames=0
+        self.samples=0
+        self.decode=Histogram()
+        self.callback=Histogram()
+        self.gaps=0
+        self.gap_ns=0
+
+    def frame(self, tstamp, samples, expected_ns):
+        """ Counts a frame with its time stamp (ns) and number of samples.
+        A gap is detected if the time stamp follows the previous one by
+        more than 1.5 times the expected interval, expected_ns (None if
+        unknown); its length is the time in excess of the interval """
+        self.frames+=1
+        self.samples+=samples
+        last=self.last_tstamp
+        self.last_tstamp=tstamp
+        if last!=None and expected_ns and tstamp-last>1.5*expected_ns:
+            self.gaps+=1
+            self.gap_ns+=tstamp-last-expected_ns
+
+
+class Metrics:
+    """ Health metrics of the streams of a HeartRate or
+    PolarMeasurementData object, enabled with metrics=True: frames and
+    samples per second, decode and queue/callback time histograms, queue
+    depth, dropped frames and gaps in the time stamps, for each stream
+    (by measurement name, 'HR' for heart rate). Keeping them costs a few
+    microseconds per frame, so they can be left on.
+
+    Read them with snapshot(), or have a snapshot passed to a callback
+    periodically with start_reporting().
+    """
+
+    def __init__(self, queue_depth=None, dropped=None):
+        """ Init the metrics.
+
+        Args:
+
+        queue_depth: a function returning the number of items in the
+                     queue of a stream, or None
+        dropped:     a function returning the number of frames of a
+                     stream dropped so far
+        """
+        self.streams={}
+        self._queue_depth=queue_depth
+        self._dropped=dropped
+        self._task=None
+
+    def stream(self, name):
+        """ Returns the StreamMetrics of the named stream, creating them
+        if needed """
+        try:
+            return self.streams[name]
+        except KeyError:
+            stream=self.streams[name]=StreamMetrics()
+            return stream
+
+    def snapshot(self, reset=False):
+        """ Returns a dictionary with a StreamSnapshot for each stream. If
+        reset is True, counters are restarted, so that the next snapshot
+        covers the time since this one. """
+        now=perf_counter_ns()
+        result={}
+        for name, stream in self.streams.items():
+            seconds=(now-stream.since)/1e9
+            result[name]=StreamSnapshot(
+                stream.frames, stream.samples, seconds,
+                stream.frames/seconds if seconds>0 else 0.0,
+                stream.samples/seconds if seconds>0 else 0.0,
+                stream.decode.copy() if not reset else stream.decode,
+                stream.callback.copy() if not reset else stream.callback,
+                self._queue_depth(name) if self._queue_depth else None,
+                self._dropped(name) if self._dropped else 0,
+                stream.gaps, stream.gap_ns/1e9)
+            if reset:
+                stream.reset()
+        return result
+
+    def start_reporting(self, callback, interval=10):
+        """ Passes a snapshot (see snapshot) to callback, a function or
+        coroutine function, every interval seconds. Each snapshot covers
+        the time since the previous one. """
+        self.stop_reporting()
+        self._task=aio.ensure_future(self._report(callback, interval))
+
+    def stop_reporting(self):
+        """ Stops periodic snapshots """
+        if self._task!=None:
+            self._task.cancel()
+            self._task=None
+
+    async def _report(self, callback, interval):
+        is_coro=iscoroutinefunction(callback)
+        self.snapshot(reset=True)
+        while True:
+            await aio.sleep(interval)
+            snapshot=self.snapshot(reset=True)
+            if is_coro:
+                await callback(snapshot)
+            else:
+                callback(snapshot)
@@ -0,0 +1,326 @@
+"""
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+import asyncio as aio
+import struct
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from ._core import HeartRate, PolarMeasurementData, _delta_frame_blocks
+
+
+# File format: an 8-byte magic string, followed by one record per
+# notification: host arrival time (int64, ns), characteristic code (uint8,
+# an index into CHARACTERISTICS), payload length (uint16), all little
+# endian, followed by the payload itself.
+MAGIC=b'BLKHREC1'
+CHARACTERISTICS=[HeartRate.CHARACTERISTIC,
+                 PolarMeasurementData.PMDCTRLPOINT,
+                 PolarMeasurementData.PMDDATAMTU]
+_RECORD=struct.Struct('<qBH')
+
+
+class Recorder:
+    """ Records raw BLE notifications, with their host arrival time, to an
+    append-only binary file. Pass a Recorder to HeartRate and/or
+    PolarMeasurementData to record every notification they receive
+    (including PMD control point responses). Recording does not block the
+    event loop: records are accumulated in memory and written out in
+    batches by a dedicated thread, when buffer_size bytes have accumulated
+    or flush_ms milliseconds after the first unwritten record. Use
+    read_recording to read the file back.
+
+    The recorder is an asynchronous context manager; otherwise, await
+    close() when done.
+    """
+
+    def __init__(self, path, buffer_size=65536, flush_ms=1000):
+        """ Init the recorder, opening the file for appending.
+
+        Args:
+
+        path:        the file to record to; if it exists, it must be a
+                     recording, and new records are appended to it
+        buffer_size: number of bytes accumulated before a write
+        flush_ms:    maximum time in milliseconds a record is held in
+                     memory before being written
+
+        Attributes:
+
+        records: the number of notifications recorded so far
+        """
+        self.path=path
+        self.buffer_size=buffer_size
+        self.flush_ms=flush_ms
+        self.records=0
+        self._codes={c: i for i, c in enumerate(CHARACTERISTICS)}
+        self._file=open(path, 'ab')
+        if self._file.tell()==0:
+            self._file.write(MAGIC)
+        else:
+            with open(path, 'rb') as f:
+                if f.read(len(MAGIC))!=MAGIC:
+                    self._file.close()
+                    raise ValueError(f"{path} is not a bleakheart recording")
+        self._buffer=bytearray()
+        self._timer=None
+        # a single thread writes the buffers out in order
+        self._executor=ThreadPoolExecutor(max_workers=1)
+        self._write_future=None
+
+    def record(self, characteristic, tstamp, data):
+        """ Records a notification from the given characteristic, received
+        at host time tstamp (ns). Called by the notification handlers. """
+        self._buffer+=_RECORD.pack(tstamp, self._codes[characteristic],
+                                   len(data))
+        self._buffer+=data
+        self.records+=1
+        if len(self._buffer)>=self.buffer_size:
+            self._submit()
+        elif self._timer==None:
+            loop=aio.get_running_loop()
+            self._timer=loop.call_later(self.flush_ms/1000, self._submit)
+
+    def _submit(self):
+        """ Hands the buffer over to the writer thread """
+        if self._timer!=None:
+            self._timer.cancel()
+            self._timer=None
+        if len(self._buffer)==0:
+            return
+        buffer=self._buffer
+        self._buffer=bytearray()
+        self._write_future=self._executor.submit(self._write, buffer)
+
+    def _write(self, buffer):
+        """ Runs in the writer thread """
+        self._file.write(buffer)
+        self._file.flush()
+
+    async def flush(self):
+        """ Writes out all records, and waits for the write to complete """
+        self._submit()
+        if self._write_future!=None:
+            await aio.wrap_future(self._write_future)
+
+    async def close(self):
+        """ Writes out all records and closes the file """
+        await self.flush()
+        await aio.wrap_future(self._executor.submit(self._file.close))
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+def read_recording(path):
+    """ Reads a file written by a Recorder.
+
+    Yields:
+        (tstamp, characteristic, data) tuples, in recording order, where
+        tstamp is the host arrival time in ns, characteristic the UUID of
+        the characteristic that sent the notification and data a bytearray
+
+    Raises:
+        ValueError if the file is not a recording. A truncated last
+        record (e.g. after a crash) is ignored.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC))!=MAGIC:
+            raise ValueError(f"{path} is not a bleakheart recording")
+        while True:
+            header=f.read(_RECORD.size)
+            if len(header)<_RECORD.size:
+                return
+            tstamp, code, length=_RECORD.unpack(header)
+            data=f.read(length)
+            if len(data)<length:
+                return
+            yield tstamp, CHARACTERISTICS[code], bytearray(data)
+
+
+ReplayStats=namedtuple('ReplayStats', ['frames', 'samples', 'seconds',
+                                       'frames_per_s', 'samples_per_s'])
+ReplayStats.__doc__=""" Throughput of a replay: number of notifications
+(frames) and samples replayed, elapsed time in seconds, and the resulting
+rates. Heart rate samples are RR intervals (or frames, without RR). """
+
+
+class ReplayClient:
+    """ A stand-in for BleakClient that replays a recording made by a
+    Recorder into the notification handlers of HeartRate and
+    PolarMeasurementData objects, exactly as if the notifications came
+    from bleak. Use it for regression and performance testing.
+
+    Control point requests written by PolarMeasurementData are answered
+    with the matching response found in the recording if any (so that,
+    e.g., the FACTOR returned by a Verity is reproduced), or else with a
+    success response. The recording is loaded in memory when the client
+    is created, so that replay speed is not limited by file access.
+
+    Usage:
+        client=ReplayClient('session.rec')
+        pmd=PolarMeasurementData(client, ecg_queue=queue)
+        await pmd.start_streaming('ECG')
+        stats=await client.run()
+    """
+    BATTERY_LEVEL="00002a19-0000-1000-8000-00805f9b34fb"
+
+    def __init__(self, path, realtime=False, speed=1.0, address='REPLAY',
+                 disconnected_callback=None):
+        """ Init the replay client.
+
+        Args:
+
+        path:     the recording to replay
+        realtime: if True, notifications are delivered with the timing
+                  they were recorded with (scaled by speed); otherwise, as
+                  fast as the handlers can process them
+        speed:    playback speed in real time mode
+        address:  the device address reported by the client
+        disconnected_callback: a function called with the client as its
+                  argument when the replay is over, as in BleakClient
+
+        Attributes:
+
+        is_connected: True until the replay is over
+        stats:        the ReplayStats of the last run, or None
+        """
+        self.path=path
+        self.realtime=realtime
+        self.speed=speed
+        self.address=address
+        self.is_connected=True
+        self.stats=None
+        self._disconnected_callback=disconnected_callback
+        self._handlers={}
+        self._records=[]
+        self._ctrl_responses={}
+        for tstamp, char, data in read_recording(path):
+            if char==PolarMeasurementData.PMDCTRLPOINT:
+                # keep the first response to each (op code, measurement)
+                self._ctrl_responses.setdefault((data[1], data[2]), data)
+            else:
+                self._records.append((tstamp, char, data))
+        # settings of the PMD streams started, by measurement code
+        self._settings={}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.disconnect()
+
+    async def connect(self, **kwargs):
+        return True
+
+    async def disconnect(self):
+        if self.is_connected:
+            self.is_connected=False
+            if self._disconnected_callback!=None:
+                self._disconnected_callback(self)
+        return True
+
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        self._handlers[str(char_specifier).lower()]=callback
+
+    async def stop_notify(self, char_specifier):
+        self._handlers.pop(str(char_specifier).lower(), None)
+
+    async def read_gatt_char(self, char_specifier, **kwargs):
+        """ Answers reads of the PMD control point (features available in
+        the recording) and battery level """
+        char=str(char_specifier).lower()
+        if char==PolarMeasurementData.PMDCTRLPOINT.lower():
+            flags=0
+            for _, c, data in self._records:
+                if c==PolarMeasurementData.PMDDATAMTU:
+                    flags|=1<<data[0]
+            return bytearray([0x0F])+flags.to_bytes(2, 'little')
+        if char==self.BATTERY_LEVEL:
+            return bytearray([100])
+        raise ValueError(f"Characteristic {char_specifier} not available")
+
+    async def write_gatt_char(self, char_specifier, data, response=None):
+        """ Answers PMD control point requests """
+        if (str(char_specifier).lower()!=
+            PolarMeasurementData.PMDCTRLPOINT.lower()):
+            return
+        op, mtype=data[0], data[1]
+        if op==PolarMeasurementData.op_codes['START']:
+            self._settings[mtype]=self._parse_request(data[2:])
+        reply=self._ctrl_responses.get((op, mtype),
+                                       bytearray([0xF0, op, mtype, 0, 0]))
+        handler=self._handlers.get(str(char_specifier).lower())
+        if handler!=None:
+            await handler(char_specifier, bytearray(reply))
+
+    def _parse_request(self, data):
+        """ Decodes the settings of a START request """
+        settings={}
+        offset=0
+        while offset<len(data):
+            name=PolarMeasurementData.settings[data[offset]]
+            wlen=PolarMeasurementData.setting_sizes.get(name, 2)
+            settings[name]=int.from_bytes(data[offset+2:offset+2+wlen],
+                                          'little')
+            offset+=2+wlen
+        return settings
+
+    def _count_samples(self, char, data):
+        """ Number of samples in a notification """
+        if char==HeartRate.CHARACTERISTIC:
+            flags=data[0]
+            offset=(3 if flags & 1 else 2)+(2 if flags & 8 else 0)
+            return max((len(data)-offset)//2, 1) if flags & 16 else 1
+        measurement=PolarMeasurementData.measurement_types[data[0]]
+        settings=self._settings.get(data[0], {})
+        channels=settings.get('CHANNELS', PolarMeasurementData.
+                              sample_channels.get(measurement, 1))
+        if data[9] & 0x80:
+            _, blocks=_delta_frame_blocks(data, settings.get('RESOLUTION',
+                                                             16), channels)
+            return 1+sum(count for _, count, _ in blocks)
+        size=PolarMeasurementData.raw_frame_sizes.get((measurement,
+                                                       data[9]))
+        return (len(data)-10)//(size*channels) if size!=None else 1
+
+    async def run(self):
+        """ Replays the recording into the handlers registered through
+        start_notify; notifications for characteristics without a handler
+        are skipped. Disconnects when done.
+
+        Returns:
+            A ReplayStats tuple
+        """
+        loop=aio.get_running_loop()
+        frames=samples=0
+        start=loop.time()
+        first=None
+        for tstamp, char, data in self._records:
+            handler=self._handlers.get(char.lower())
+            if handler==None:
+                continue
+            if self.realtime:
+                if first==None:
+                    first=tstamp
+                delay=start+(tstamp-first)/1e9/self.speed-loop.time()
+                await aio.sleep(max(delay, 0))
+            else:
+                # let consumers run, as they would between notifications
+                await aio.sleep(0)
+            # handlers may keep a reference to the data
+            await handler(char, bytearray(data))
+            frames+=1
+            samples+=self._count_samples(char, data)
+        seconds=loop.time()-start
+        self.stats=ReplayStats(frames, samples, seconds,
+                               frames/seconds if seconds>0 else 0.0,
+                               samples/seconds if seconds>0 else 0.0)
+        await self.disconnect()
+        return self.stats
@@ -0,0 +1,478 @@
+"""
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+import asyncio as aio
+from collections import namedtuple
+from inspect import iscoroutinefunction
+from time import monotonic, time_ns
+from bleak import BleakClient
+from ._batching import FrameBatch
+from ._core import HeartRate, PolarMeasurementData
+
+
+DeviceStats=namedtuple('DeviceStats', ['connected', 'frames', 'samples',
+                                       'seconds', 'frames_per_s',
+                                       'samples_per_s', 'error',
+                                       'outages'])
+DeviceStats.__doc__=""" Throughput of one device in a SessionManager:
+whether it is connected, the number of frames and samples received, the
+time in seconds since its streams were started, the resulting rates, the
+last error (a string) or None, and the number of connection losses. """
+
+Outage=namedtuple('Outage', ['address', 'disconnected', 'restored',
+                             'attempts', 'gap_s', 'errors'])
+Outage.__doc__=""" A connection loss handled by a Supervisor: the device
+address, the Epoch times in ns at which the disconnection was detected and
+the streams were restored (None if the Supervisor gave up), the number of
+connection attempts, the length in seconds of the gap in the data, from
+the last frame received before the loss (or its detection, if there was
+none) to the first frame received after it (None if the Supervisor gave
+up, or no frame arrived within its frame_timeout), and a dictionary of
+error messages for the streams that could not be restarted (or for
+'connect'). """
+
+
+def _count_samples(frame):
+    """ Number of samples in a frame or batch; raw frames count as one """
+    if isinstance(frame, FrameBatch):
+        return sum(frame.counts)
+    payload=frame[2]
+    if frame[0]=='HR':
+        # a heartbeat, or a frame with a list of RR intervals
+        return len(payload[1]) if isinstance(payload[1], list) else 1
+    if isinstance(payload, (bytes, bytearray)):
+        return 1
+    return len(payload)
+
+
+class Supervisor:
+    """ Keeps a device connected: when the connection drops, reconnects
+    with exponential backoff, restarts heart rate notifications and the
+    PMD streams that were active (with the same settings, see
+    HeartRate.resume_notify and PolarMeasurementData.resume_streaming),
+    and reports the outage.
+
+    Bleak only accepts a disconnected callback when the client is 
+    created; pass one that calls the disconnected method of the 
+    Supervisor, so that the outage is handled at once. Otherwise, the 
+    connection is polled. Usage:
+
+        client=BleakClient(device, disconnected_callback=lambda client:
+                           supervisor.disconnected(client))
+        pmd=PolarMeasurementData(client, ...)
+        supervisor=Supervisor(client, pmd=pmd, callback=print)
+        await client.connect()
+        await pmd.start_streaming('ECG')
+        supervisor.start()
+    """
+
+    def __init__(self, client, heartrate=None, pmd=None, callback=None,
+                 min_backoff=0.5, max_backoff=30, max_attempts=None,
+                 connect_timeout=10, poll=1.0, frame_timeout=10):
+        """ Init the supervisor.
+
+        Args:
+
+        client:      the BleakClient of the device
+        heartrate:   the HeartRate object of the device, if any
+        pmd:         the PolarMeasurementData object of the device, if any
+        callback:    a function or coroutine function to which an Outage
+                     is passed after each reconnection, or when giving up
+        min_backoff: delay before the second connection attempt, in
+                     seconds; the first is made at once. The delay doubles
+                     after each failed attempt
+        max_backoff: longest delay between connection attempts, in seconds
+        max_attempts: number of connection attempts after which the
+                     supervisor gives up; if None, it never does
+        connect_timeout: timeout of each connection attempt, in seconds
+        poll:        interval at which the connection is checked, in
+                     seconds, if disconnected is not called
+        frame_timeout: time to wait for the first frame after the
+                     streams are restored, in seconds; the outage is
+                     reported when it arrives, or after this time
+
+        Attributes:
+
+        outages: a list of the Outage tuples reported so far
+        """
+        self.client=client
+        self.heartrate=heartrate
+        self.pmd=pmd
+        self.callback=callback
+        self._callback_is_coro=iscoroutinefunction(callback)
+        self.min_backoff=min_backoff
+        self.max_backoff=max_backoff
+        self.max_attempts=max_attempts
+        self.connect_timeout=connect_timeout
+        self.poll=poll
+        self.frame_timeout=frame_timeout
+        self.outages=[]
+        self._lost=aio.Event()
+        self._lost_at=None
+        self._task=None
+
+    def disconnected(self, client=None):
+        """ Notifies the supervisor that the connection dropped; can be
+        called from the disconnected callback of the client """
+        if self._lost_at==None:
+            self._lost_at=time_ns()
+        self._lost.set()
+
+    def start(self):
+        """ Starts supervising the connection in a task """
+        if self._task==None:
+            self._task=aio.ensure_future(self.run())
+
+    async def stop(self):
+        """ Stops supervising; call before disconnecting on purpose """
+        if self._task!=None:
+            self._task.cancel()
+            await aio.gather(self._task, return_exceptions=True)
+            self._task=None
+
+    async def run(self):
+        """ Supervises the connection until stopped, or until giving up
+        after max_attempts """
+        while True:
+            while self.client.is_connected:
+                try:
+                    await aio.wait_for(self._lost.wait(), self.poll)
+                except aio.TimeoutError:
+                    pass
+                self._lost.clear()
+            outage=await self._reconnect()
+            self.outages.append(outage)
+            if self.callback!=None:
+                if self._callback_is_coro:
+                    await self.callback(outage)
+                else:
+                    self.callback(outage)
+            if outage.restored==None:
+                return
+
+    async def _reconnect(self):
+        """ Reconnects and restores the streams. Returns an Outage. """
+        lost=self._lost_at if self._lost_at!=None else time_ns()
+        # the data gap starts with the last frame before the loss
+        last=self._last_frame()
+        if last==None or last>lost:
+            last=lost
+        address=getattr(self.client, 'address', None)
+        delay=self.min_backoff
+        attempts=0
+        while True:
+            attempts+=1
+            try:
+                await self.client.connect(timeout=self.connect_timeout)
+                errors=await self._restore()
+                break
+            except Exception as e:
+                error=str(e) or type(e).__name__
+                if self.client.is_connected:
+                    # connected, but the streams could not be restarted
+                    try:
+                        await self.client.disconnect()
+                    except Exception:
+                        pass
+            if self.max_attempts!=None and attempts>=self.max_attempts:
+                self._lost_at=None
+                return Outage(address, lost, None, attempts, None,
+                              {'connect': error})
+            await aio.sleep(delay)
+            delay=min(delay*2, self.max_backoff)
+        self._lost_at=None
+        self._lost.clear()
+        restored=time_ns()
+        first=await self._first_frame(lost)
+        return Outage(address, lost, restored, attempts,
+                      (first-last)/1e9 if first!=None else None, errors)
+
+    def _last_frame(self):
+        """ Arrival time in ns of the last frame of the device, or None """
+        times=[source.last_frame for source in (self.heartrate, self.pmd)
+               if source!=None and source.last_frame!=None]
+        return max(times) if times else None
+
+    async def _first_frame(self, since):
+        """ Waits for the first frame received after since (Epoch time in
+        ns). Returns its arrival time, or None if none arrives within
+        frame_timeout or the connection drops again. """
+        if self.heartrate==None and self.pmd==None:
+            return None
+        deadline=monotonic()+self.frame_timeout
+        while True:
+            last=self._last_frame()
+            if last!=None and last>since:
+                return last
+            if monotonic()>=deadline or not self.client.is_connected:
+                return None
+            # the arrival time is recorded by the handlers, so polling
+            # only delays the report
+            await aio.sleep(0.05)
+
+    async def _restore(self):
+        """ Restarts the streams; returns the errors by measurement """
+        errors={}
+        if self.heartrate!=None:
+            await self.heartrate.resume_notify()
+        if self.pmd!=None:
+            results=await self.pmd.resume_streaming()
+            for meas, (err_code, err_msg) in results.items():
+                if err_code!=0:
+                    errors[meas]=err_msg
+        return errors
+
+
+class _Device:
+    """ State of one device in a SessionManager """
+    def __init__(self, device):
+        self.device=device
+        self.address=(device if isinstance(device, str)
+                      else getattr(device, 'address', str(device)))
+        self.client=None
+        self.heartrate=None
+        self.pmd=None
+        self.connected=False
+        self.error=None
+        self.frames=0
+        self.samples=0
+        self.started=None
+        self.supervisor=None
+        self.outages=0
+
+
+class SessionManager:
+    """ Connects to several devices concurrently in the same event loop,
+    starts the requested streams on each, and passes the data of all
+    devices to a shared queue or callback, as (address, frame) tuples,
+    where frame is as described for HeartRate and PolarMeasurementData.
+
+    The number of concurrent connection attempts (including the setup of
+    the streams) is limited, since BLE adapters handle few at a time.
+    Devices that fail to connect or to start a stream are disconnected
+    and reported in stats() rather than raising. With reconnect, devices
+    that drop out later are reconnected by a Supervisor.
+
+    The manager is an asynchronous context manager; otherwise, await
+    start() and stop(). Usage:
+
+        manager=SessionManager(addresses, {'HR': {}, 'ECG': {}},
+                               queue=queue)
+        async with manager:
+            while True:
+                address, frame=await queue.get()
+                ...
+    """
+
+    def __init__(self, devices, measurements, queue=None, callback=None,
+                 max_connecting=2, client_factory=BleakClient,
+                 connect_timeout=20, hr_options=None, pmd_options=None,
+                 reconnect=False):
+        """ Init the session manager.
+
+        Args:
+
+        devices:        a list of device addresses or BLEDevice objects
+        measurements:   a dictionary with the measurements to stream from
+                        each device as keys ('HR' for heart rate, or one of
+                        PolarMeasurementData.measurement_types), and a
+                        dictionary of settings for start_streaming (or of
+                        arguments for HeartRate.start_notify) as values
+        queue:          an asyncio queue (or any object with a put_nowait
+                        method) onto which (address, frame) tuples are
+                        pushed; alternatively, give a callback
+        callback:       a function or coroutine function to which
+                        (address, frame) tuples are passed. Ignored if
+                        queue is given
+        max_connecting: maximum number of devices being connected at once
+        client_factory: called as client_factory(device,
+                        disconnected_callback=...) to create the client of
+                        each device; defaults to BleakClient. Use e.g.
+                        lambda device, **kwargs: SimulatedDevice(device,
+                        **kwargs) to test with simulated devices
+        connect_timeout: timeout of each connection attempt, in seconds
+        hr_options:     keyword arguments for HeartRate (e.g. unpack,
+                        instant_rate, batch_ms)
+        pmd_options:    keyword arguments for PolarMeasurementData (e.g.
+                        use_numpy, batch_ms)
+        reconnect:      if True, devices that drop out after starting are
+                        reconnected and their streams restored by a 
+                        Supervisor; a dictionary of keyword arguments for
+                        Supervisor (e.g. max_backoff, or a callback to
+                        which each Outage is passed) may also be given
+
+        Attributes:
+
+        devices: a dictionary with the state of each device, by address;
+                 its client, heartrate and pmd attributes give access to
+                 the BleakClient, HeartRate and PolarMeasurementData
+                 objects
+        """
+        if queue==None and callback==None:
+            raise RuntimeError("No queue or callback given")
+        self.measurements=measurements
+        self._sink=queue.put_nowait if queue!=None else callback
+        self._sink_is_coro=iscoroutinefunction(self._sink)
+        self.max_connecting=max_connecting
+        self.client_factory=client_factory
+        self.connect_timeout=connect_timeout
+        self.hr_options=hr_options or {}
+        self.pmd_options=pmd_options or {}
+        if reconnect==True:
+            reconnect={}
+        self.reconnect=reconnect if reconnect!=False else None
+        self.devices={}
+        for device in devices:
+            state=_Device(device)
+            self.devices[state.address]=state
+        self._semaphore=None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def start(self):
+        """ Connects to all devices, at most max_connecting at a time, and
+        starts the requested streams on each.
+
+        Returns:
+            A list of the addresses of the devices that were connected
+            and started successfully
+        """
+        self._semaphore=aio.Semaphore(self.max_connecting)
+        results=await aio.gather(*[self._start_device(state) for state
+                                   in self.devices.values()])
+        return [address for address, ok in zip(self.devices, results) if ok]
+
+    def _make_sink(self, state):
+        """ Returns a callback that counts the frames of the device, tags
+        them with its address and passes them on to the shared sink """
+        sink=self._sink
+        address=state.address
+        if self._sink_is_coro:
+            async def tagged(frame):
+                state.frames+=1
+                state.samples+=_count_samples(frame)
+                await sink((address, frame))
+        else:
+            def tagged(frame):
+                state.frames+=1
+                state.samples+=_count_samples(frame)
+                sink((address, frame))
+        return tagged
+
+    def _on_disconnect(self, state):
+        """ Returns the disconnected callback of the device's client """
+        def disconnected(client):
+            state.connected=False
+            if state.supervisor!=None:
+                state.supervisor.disconnected(client)
+        return disconnected
+
+    def _make_supervisor(self, state):
+        """ Returns a Supervisor for the device, which keeps its state up
+        to date and passes outages on to the callback, if any """
+        options=dict(self.reconnect)
+        callback=options.pop('callback', None)
+        is_coro=iscoroutinefunction(callback)
+        async def outage(outage):
+            state.outages+=1
+            state.connected=outage.restored!=None
+            state.error=(None if outage.restored!=None and not outage.errors
+                         else '; '.join(f'{key}: {msg}' for key, msg
+                                        in outage.errors.items()))
+            if callback!=None:
+                if is_coro:
+                    await callback(outage)
+                else:
+                    callback(outage)
+        return Supervisor(state.client, state.heartrate, state.pmd,
+                          callback=outage, **options)
+
+    async def _start_device(self, state):
+        """ Connects to a device and starts its streams. Returns True on
+        success; otherwise records the error and returns False. """
+        async with self._semaphore:
+            try:
+                state.client=self.client_factory(
+                    state.device,
+                    disconnected_callback=self._on_disconnect(state))
+                await state.client.connect(timeout=self.connect_timeout)
+                state.connected=True
+                sink=self._make_sink(state)
+                if 'HR' in self.measurements:
+                    state.heartrate=HeartRate(state.client, callback=sink,
+                                              **self.hr_options)
+                if any(meas!='HR' for meas in self.measurements):
+                    state.pmd=PolarMeasurementData(state.client,
+                                                   callback=sink,
+                                                   **self.pmd_options)
+                state.started=monotonic()
+                if state.heartrate!=None:
+                    await state.heartrate.start_notify(
+                        **self.measurements['HR'])
+                if state.pmd!=None:
+                    results=await state.pmd.start_many(
+                        {meas: settings for meas, settings
+                         in self.measurements.items() if meas!='HR'})
+                    for meas, (err_code, err_msg, _) in results.items():
+                        if err_code!=0:
+                            raise RuntimeError(f"Could not start {meas}: "
+                                               f"{err_msg}")
+                if self.reconnect!=None:
+                    state.supervisor=self._make_supervisor(state)
+                    state.supervisor.start()
+            except Exception as e:
+                state.error=str(e) or type(e).__name__
+                # do not leave a partly started device connected
+                if state.client!=None and state.client.is_connected:
+                    try:
+                        await state.client.disconnect()
+                    except Exception:
+                        pass
+                state.connected=False
+                return False
+            state.error=None
+            return True
+
+    async def stop(self):
+        """ Stops the streams of all devices and disconnects them """
+        await aio.gather(*[self._stop_device(state) for state
+                           in self.devices.values()])
+
+    async def _stop_device(self, state):
+        if state.supervisor!=None:
+            await state.supervisor.stop()
+            state.supervisor=None
+        if state.client==None or not state.client.is_connected:
+            return
+        try:
+            for meas in self.measurements:
+                if meas=='HR' and state.heartrate!=None:
+                    await state.heartrate.stop_notify()
+                elif meas!='HR' and state.pmd!=None:
+                    await state.pmd.stop_streaming(meas)
+            await state.client.disconnect()
+        except Exception as e:
+            state.error=str(e) or type(e).__name__
+        state.connected=False
+
+    def stats(self):
+        """ Returns a dictionary with the DeviceStats of each device, by
+        address """
+        now=monotonic()
+        result={}
+        for address, state in self.devices.items():
+            seconds=now-state.started if state.started!=None else 0.0
+            result[address]=DeviceStats(
+                state.connected, state.frames, state.samples, seconds,
+                state.frames/seconds if seconds>0 else 0.0,
+                state.samples/seconds if seconds>0 else 0.0, state.error,
+                state.outages)
+        return result
@@ -0,0 +1,408 @@
+"""
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+import asyncio as aio
+import math
+import random
+import struct
+from time import time_ns
+from ._core import BatteryLevel, HeartRate, PolarMeasurementData
+
+
+# Polar sensors count time in ns from 2000-01-01T00:00:00 UTC
+SENSOR_EPOCH=946684800*10**9
+
+
+def _delta_bit_width(deltas):
+    """ Smallest number of bits that holds all deltas as two's complement
+    signed integers """
+    width=0
+    for d in deltas:
+        width=max(width, (d if d>=0 else -d-1).bit_length()+1)
+    return width
+
+
+def _encode_delta_frame(samples, resolution, channels):
+    """ Encodes samples as the data section of a compressed (delta) PMD
+    frame, as decoded by _decode_delta_frame: the first sample is the
+    reference, followed by delta packages of at most 255 samples. Deltas
+    are packed least significant bit first.
+
+    Args:
+        samples:    a list of samples, each a list of channel values; for
+                    single channel measurements, a list of values
+        resolution: the sample resolution in bits
+        channels:   the number of channels in each sample
+
+    Returns:
+        A bytearray with the data following the 10-byte frame header
+    """
+    if channels==1:
+        samples=[[s] for s in samples]
+    sample_size=math.ceil(resolution/8)
+    data=bytearray()
+    for value in samples[0]:
+        data+=value.to_bytes(sample_size, 'little', signed=True)
+    for start in range(1, len(samples), 255):
+        block=samples[start:start+255]
+        prev=samples[start-1]
+        deltas=[]
+        for sample in block:
+            deltas.extend(v-p for v, p in zip(sample, prev))
+            prev=sample
+        width=_delta_bit_width(deltas)
+        mask=(1<<width)-1
+        bits=0
+        for i, d in enumerate(deltas):
+            bits|=(d & mask)<<(i*width)
+        data+=bytes([width, len(block)])
+        data+=bits.to_bytes(math.ceil(width*len(deltas)/8), 'little')
+    return data
+
+
+class SimulatedDevice:
+    """ A simulated Polar sensor that stands in for BleakClient, for
+    testing and load testing without hardware. It answers the PMD control
+    point protocol (GET, START and STOP requests, with 0xF0 responses and
+    the error codes in PolarMeasurementData.error_msgs), and generates
+    synthetic heart rate notifications and ECG, ACC and PPG data frames at
+    the sampling rates requested in START. Many devices can run in the same
+    event loop.
+
+    Signals are cheap approximations: an ECG with R and T waves and a PPG
+    pulse at the configured heart rate, gravity plus a slow sway for ACC,
+    and Gaussian noise; RR intervals vary randomly around the mean.
+
+    Usage:
+        device=SimulatedDevice(compressed=('PPG',))
+        pmd=PolarMeasurementData(device, ppg_queue=queue)
+        await pmd.start_streaming('PPG')
+    """
+    # settings available for each measurement, as returned by GET; the
+    # first value of each setting is used if START does not specify it
+    default_capabilities={
+        'ECG': {'SAMPLE_RATE': [130], 'RESOLUTION': [14]},
+        'ACC': {'SAMPLE_RATE': [200, 25, 50, 100], 'RESOLUTION': [16],
+                'RANGE': [2, 4, 8]},
+        'PPG': {'SAMPLE_RATE': [55], 'RESOLUTION': [22], 'CHANNELS': [4]}}
+    # number of samples per frame, roughly as sent by Polar sensors
+    frame_samples={'ECG': 73, 'ACC': 36, 'PPG': 35}
+    # uncompressed frame types sent; other measurements are always sent
+    # as compressed frames
+    raw_frame_types={'ECG': 0x00, 'ACC': 0x01, 'PPG': 0x00}
+    # error code for an invalid value of each setting
+    setting_errors={'SAMPLE_RATE': 8, 'RESOLUTION': 7, 'RANGE': 9,
+                    'CHANNELS': 11}
+
+    def __init__(self, address='SIMULATED', capabilities=None,
+                 compressed=(), heart_rate=60, rr_sd_ms=30,
+                 frame_samples=None, factors=None, drift_ppm=0,
+                 response_ms=0, battery=100, errors=None, seed=None,
+                 disconnected_callback=None):
+        """ Init the simulated device.
+
+        Args:
+
+        address:       the device address reported by the client
+        capabilities:  a dictionary of the measurements supported, with the
+                       allowed values of each setting; defaults to
+                       default_capabilities
+        compressed:    the measurements sent as compressed (delta) frames;
+                       those in raw_frame_types are otherwise sent
+                       uncompressed (ECG and PPG as 24 bit values, ACC as
+                       16 bit)
+        heart_rate:    mean heart rate in beats per minute
+        rr_sd_ms:      standard deviation of the RR intervals, in ms
+        frame_samples: a dictionary overriding frame_samples for some
+                       measurements
+        factors:       a dictionary with the FACTOR returned in the START
+                       response of some measurements (as the Verity does)
+        drift_ppm:     how much slower the sensor clock runs than the host
+                       clock, in parts per million
+        response_ms:   delay of control point responses, in ms
+        battery:       the battery level returned, in percent
+        errors:        a dictionary mapping (op, measurement) pairs, e.g.
+                       ('START', 'ECG'), to the error code returned for
+                       that request, to simulate failures
+        seed:          seed of the random number generator
+        disconnected_callback: a function called with the device as its
+                       argument on disconnection, as in BleakClient
+
+        Attributes:
+
+        is_connected: True unless disconnect() was called
+        streaming:    a dictionary with the settings of the measurements
+                      being streamed
+        """
+        self.address=address
+        self.capabilities=(capabilities if capabilities!=None
+                           else self.default_capabilities)
+        self.compressed=set(compressed)
+        self.heart_rate=heart_rate
+        self.rr_sd_ms=rr_sd_ms
+        self.frame_samples={**self.frame_samples, **(frame_samples or {})}
+        self.factors=factors or {}
+        self.drift=drift_ppm/1e6
+        self.response_ms=response_ms
+        self.battery=battery
+        self.errors=errors or {}
+        self.is_connected=True
+        self.streaming={}
+        self._rng=random.Random(seed)
+        self._disconnected_callback=disconnected_callback
+        self._handlers={}
+        self._tasks={}
+        # host and sensor clocks at creation, for time stamps
+        self._host0=time_ns()
+        self._sensor0=self._host0-SENSOR_EPOCH
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.disconnect()
+
+    async def connect(self, **kwargs):
+        self.is_connected=True
+        return True
+
+    async def disconnect(self):
+        """ Stops all notifications and streams """
+        if not self.is_connected:
+            return True
+        self.is_connected=False
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+        self._handlers.clear()
+        self.streaming.clear()
+        if self._disconnected_callback!=None:
+            self._disconnected_callback(self)
+        return True
+
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        char=str(char_specifier).lower()
+        self._handlers[char]=callback
+        if char==HeartRate.CHARACTERISTIC and 'HR' not in self._tasks:
+            self._tasks['HR']=aio.ensure_future(self._heart_rate())
+
+    async def stop_notify(self, char_specifier):
+        char=str(char_specifier).lower()
+        self._handlers.pop(char, None)
+        if char==HeartRate.CHARACTERISTIC and 'HR' in self._tasks:
+            self._tasks.pop('HR').cancel()
+
+    async def read_gatt_char(self, char_specifier, **kwargs):
+        """ Answers reads of the PMD control point (the measurements
+        supported) and of the battery level """
+        char=str(char_specifier).lower()
+        if char==PolarMeasurementData.PMDCTRLPOINT.lower():
+            flags=0
+            for measurement in self.capabilities:
+                flags|=1<<PolarMeasurementData.measurement_types.index(
+                    measurement)
+            return bytearray([0x0F])+flags.to_bytes(2, 'little')
+        if char==BatteryLevel.CHARACTERISTIC:
+            return bytearray([self.battery])
+        raise ValueError(f"Characteristic {char_specifier} not available")
+
+    async def write_gatt_char(self, char_specifier, data, response=None):
+        """ Answers PMD control point requests; the response is notified
+        after response_ms """
+        if (str(char_specifier).lower()!=
+            PolarMeasurementData.PMDCTRLPOINT.lower()):
+            return
+        reply=self._control(bytearray(data))
+        loop=aio.get_running_loop()
+        loop.call_later(self.response_ms/1000, self._notify_ctrl, reply)
+
+    def _notify_ctrl(self, reply):
+        handler=self._handlers.get(PolarMeasurementData.PMDCTRLPOINT.lower())
+        if handler!=None:
+            aio.ensure_future(handler(PolarMeasurementData.PMDCTRLPOINT,
+                                      reply))
+
+    def _control(self, request):
+        """ Executes a control point request and returns the response """
+        if len(request)<2:
+            return bytearray([0xF0]+list(request[:1])+[0, 4, 0])
+        op, mtype=request[0], request[1]
+        reply=bytearray([0xF0, op, mtype, 0, 0])
+        ops={code: name for name, code in
+             PolarMeasurementData.op_codes.items()}
+        types=PolarMeasurementData.measurement_types
+        if op not in ops:
+            reply[3]=1     # INVALID OP CODE
+            return reply
+        if mtype>=len(types) or types[mtype]=='rfu':
+            reply[3]=2     # INVALID MEASUREMENT TYPE
+            return reply
+        measurement=types[mtype]
+        if (ops[op], measurement) in self.errors:
+            reply[3]=self.errors[ops[op], measurement]
+        elif measurement not in self.capabilities:
+            reply[3]=3     # NOT SUPPORTED
+        elif ops[op]=='GET':
+            reply+=self._encode_settings(self.capabilities[measurement])
+        elif ops[op]=='START':
+            if measurement in self.streaming:
+                reply[3]=6 # ALREADY IN STATE
+                return reply
+            settings, reply[3]=self._parse_start(measurement, request[2:])
+            if reply[3]==0:
+                self._start(measurement, settings)
+                if measurement in self.factors:
+                    reply+=bytes([PolarMeasurementData.settings.index(
+                        'FACTOR'), 1])
+                    reply+=struct.pack('<f', self.factors[measurement])
+        else:
+            if measurement not in self.streaming:
+                reply[3]=6 # ALREADY IN STATE
+            else:
+                del self.streaming[measurement]
+                self._tasks.pop(measurement).cancel()
+        return reply
+
+    def _encode_settings(self, settings):
+        """ Encodes settings as in the response to a GET request """
+        data=bytearray()
+        for name, values in settings.items():
+            wlen=PolarMeasurementData.setting_sizes.get(name, 2)
+            data+=bytes([PolarMeasurementData.settings.index(name),
+                         len(values)])
+            for v in values:
+                data+=v.to_bytes(wlen, 'little')
+        return data
+
+    def _parse_start(self, measurement, data):
+        """ Decodes and validates the settings of a START request.
+
+        Returns:
+            A tuple (settings, error_code)
+        """
+        allowed=self.capabilities[measurement]
+        settings={name: values[0] for name, values in allowed.items()}
+        offset=0
+        while offset<len(data):
+            if data[offset]>=len(PolarMeasurementData.settings):
+                return None, 5 # INVALID PARAMETER
+            name=PolarMeasurementData.settings[data[offset]]
+            wlen=PolarMeasurementData.setting_sizes.get(name, 2)
+            if offset+2+wlen>len(data) or data[offset+1]!=1:
+                return None, 4 # INVALID LENGTH
+            value=int.from_bytes(data[offset+2:offset+2+wlen], 'little')
+            if value not in allowed.get(name, ()):
+                return None, self.setting_errors.get(name, 5)
+            settings[name]=value
+            offset+=2+wlen
+        return settings, 0
+
+    def _start(self, measurement, settings):
+        self.streaming[measurement]=settings
+        self._tasks[measurement]=aio.ensure_future(
+            self._stream(measurement, settings))
+
+    def _sensor_time(self, host_ns):
+        """ Sensor clock reading at host time host_ns """
+        return self._sensor0+round((host_ns-self._host0)*(1-self.drift))
+
+    async def _stream(self, measurement, settings):
+        """ Sends data frames of the measurement until cancelled """
+        loop=aio.get_running_loop()
+        mtype=PolarMeasurementData.measurement_types.index(measurement)
+        rate=settings['SAMPLE_RATE']
+        channels=settings.get('CHANNELS', PolarMeasurementData.
+                              sample_channels.get(measurement, 1))
+        count=self.frame_samples.get(measurement, max(rate//10, 1))
+        compressed=(measurement in self.compressed or
+                    measurement not in self.raw_frame_types)
+        if compressed:
+            frametype=0x80
+            resolution=settings.get('RESOLUTION', 16)
+        else:
+            frametype=self.raw_frame_types[measurement]
+            size=PolarMeasurementData.raw_frame_sizes[measurement, frametype]
+        # samples are spaced by the sampling period in sensor time
+        period=1/(rate*(1-self.drift))
+        start=loop.time()
+        sensor_start=self._sensor_time(time_ns())
+        sent=0
+        while True:
+            await aio.sleep(max(start+(sent+count)*period-loop.time(), 0))
+            samples=[self._signal(measurement, (sent+i)/rate, channels)
+                     for i in range(count)]
+            sent+=count
+            tstamp=sensor_start+round((sent-1)*1e9/rate)
+            frame=bytearray([mtype])+tstamp.to_bytes(8, 'little')
+            frame.append(frametype)
+            if compressed:
+                frame+=_encode_delta_frame(samples, resolution, channels)
+            else:
+                for sample in samples:
+                    for value in (sample if channels>1 else [sample]):
+                        frame+=value.to_bytes(size, 'little', signed=True)
+            handler=self._handlers.get(
+                PolarMeasurementData.PMDDATAMTU.lower())
+            if handler!=None:
+                await handler(PolarMeasurementData.PMDDATAMTU, frame)
+
+    def _signal(self, measurement, t, channels):
+        """ Synthetic sample of the measurement at time t (s) """
+        gauss=self._rng.gauss
+        phase=(t*self.heart_rate/60)%1
+        if measurement=='ECG':
+            # R and T waves, in microVolt
+            return round(1000*math.exp(-((phase-0.25)/0.012)**2)
+                         +200*math.exp(-((phase-0.55)/0.05)**2)
+                         +gauss(0, 10))
+        if measurement=='ACC':
+            # gravity along z, with a slow sway, in milliG
+            sway=round(50*math.sin(2*math.pi*0.3*t))
+            return [sway+round(gauss(0, 5)), round(gauss(0, 5)),
+                    1000+round(gauss(0, 5))][:channels]
+        if measurement=='PPG':
+            # three PPG channels with a pulse wave, plus ambient light
+            pulse=5000*math.sin(2*math.pi*phase)
+            sample=[round(-500000+pulse*(1+0.1*ch)+gauss(0, 50))
+                    for ch in range(min(channels, 3))]
+            sample+=[round(-650000+gauss(0, 50))]*(channels-len(sample))
+            return sample
+        sample=[round(gauss(0, 100)) for _ in range(channels)]
+        return sample if channels>1 else sample[0]
+
+    def _rr_interval(self):
+        """ A random RR interval, in s """
+        return max(self._rng.gauss(60/self.heart_rate, self.rr_sd_ms/1000),
+                   0.25)
+
+    async def _heart_rate(self):
+        """ Sends a heart rate notification every second until cancelled,
+        with the RR intervals of the beats completed in that second """
+        loop=aio.get_running_loop()
+        start=loop.time()
+        rr=self._rr_interval()
+        beat=rr  # time of the next beat, in s from start
+        second=0
+        while True:
+            second+=1
+            await aio.sleep(max(start+second-loop.time(), 0))
+            rrlist=[]
+            while beat<=second:
+                rrlist.append(rr)
+                rr=self._rr_interval()
+                beat+=rr
+            if rrlist:
+                hr=round(60*len(rrlist)/sum(rrlist))
+            else:
+                hr=round(self.heart_rate)
+            # RR intervals present, 8 bit heart rate
+            frame=bytearray([0x10, min(hr, 255)])
+            for interval in rrlist:
+                frame+=round(interval*1024).to_bytes(2, 'little')
+            handler=self._handlers.get(HeartRate.CHARACTERISTIC)
+            if handler!=None:
+                await handler(HeartRate.CHARACTERISTIC, frame)
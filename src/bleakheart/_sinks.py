@@ -0,0 +1,234 @@
+"""
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+import asyncio as aio
+import math
+from ._batching import FrameBatch
+# numpy is optional; it is required by RingBuffer
+try:
+    import numpy as np
+except ImportError:
+    np=None
+
+
+class RingBuffer:
+    """ A fixed-memory sink holding the latest samples of one measurement,
+    with their time stamps, in preallocated numpy arrays. A RingBuffer can
+    be passed to HeartRate or PolarMeasurementData in place of a queue:
+    decoded frames (or batches) are written straight into its storage, and
+    readers take views of the latest samples with latest() or last().
+
+    Each sample is stored twice, capacity samples apart, so that the latest
+    samples always lie in a contiguous region and can be returned as views
+    without copying. Views are only valid until the samples they refer to
+    are overwritten; copy them to keep the data for longer.
+
+    Per-sample time stamps (in ns) are taken from the frames if available
+    (see the sample_timestamps option of PolarMeasurementData), or else
+    computed from the frame time stamp, which refers to the last sample,
+    and sample_rate. Heart rate is supported in unpack mode (with or without
+    per_frame), with one (hr, rr) sample per heartbeat.
+    """
+
+    def __init__(self, seconds, sample_rate, channels=1, dtype='int32'):
+        """ Init the ring buffer.
+
+        Args:
+
+        seconds:     how many seconds of data the buffer holds
+        sample_rate: the sampling rate of the measurement, in Hz
+        channels:    number of channels per sample (e.g. 3 for ACC, 4 for
+                     PPG, 2 for unpacked heart rate)
+        dtype:       numpy data type of the samples; use a floating point
+                     type if the sensor returns a FACTOR
+
+        Attributes:
+
+        capacity:    the number of samples held by the buffer
+        count:       the total number of samples written so far
+        """
+        if np==None:
+            raise RuntimeError("RingBuffer requires the numpy package")
+        self.sample_rate=sample_rate
+        self.channels=channels
+        self.capacity=math.ceil(seconds*sample_rate)
+        shape=(2*self.capacity,) if channels==1 else (2*self.capacity,
+                                                       channels)
+        self._data=np.zeros(shape, dtype=dtype)
+        self._tstamps=np.zeros(2*self.capacity, dtype=np.int64)
+        self._period=round(1e9/sample_rate)
+        self._head=0 # where the next sample is written, < capacity
+        self.count=0
+
+    def put_nowait(self, frame):
+        """ Writes a (MEAS, tstamp, payload, ...) frame or a FrameBatch
+        into the buffer. Named after asyncio.Queue.put_nowait, so that the
+        buffer can be used in place of a queue. """
+        if isinstance(frame[1], np.ndarray):
+            self.write(frame[2], frame[1])
+            return
+        if isinstance(frame, FrameBatch):
+            counts=np.asarray(frame.counts)
+            tstamps=np.repeat(np.asarray(frame.tstamps, dtype=np.int64),
+                              counts)
+            # samples still to come in the same frame
+            ends=np.repeat(np.cumsum(counts), counts)
+            tstamps-=(ends-np.arange(len(tstamps))-1)*self._period
+            self.write(frame.samples, tstamps)
+            return
+        if frame[0]=='HR' and isinstance(frame[1], list):
+            # heartbeats of a frame, delivered with per_frame
+            self.write(list(zip(*frame[2])), np.asarray(frame[1],
+                                                        dtype=np.int64))
+            return
+        samples=[frame[2]] if frame[0]=='HR' else frame[2]
+        n=len(samples)
+        tstamps=(frame[1]-
+                 np.arange(n-1, -1, -1, dtype=np.int64)*self._period)
+        self.write(samples, tstamps)
+
+    def write(self, samples, tstamps):
+        """ Writes samples, with their time stamps in ns, into the buffer.
+        If there are more samples than the buffer can hold, only the latest
+        are kept. """
+        samples=np.asarray(samples)
+        if samples.ndim>1 and self.channels==1:
+            samples=samples.ravel()
+        cap=self.capacity
+        n=len(samples)
+        self.count+=n
+        if n>cap:
+            samples=samples[n-cap:]
+            tstamps=tstamps[n-cap:]
+            n=cap
+        head=self._head
+        first=min(n, cap-head) # samples written before wrapping around
+        for lo, hi, src in ((head, head+first, slice(0, first)),
+                            (0, n-first, slice(first, n))):
+            if hi>lo:
+                self._data[lo:hi]=samples[src]
+                self._data[lo+cap:hi+cap]=samples[src]
+                self._tstamps[lo:hi]=tstamps[src]
+                self._tstamps[lo+cap:hi+cap]=tstamps[src]
+        self._head=(head+n)%cap
+
+    def last(self, n):
+        """ Returns views (tstamps, samples) of the latest n samples,
+        oldest first. Fewer samples are returned if fewer are available. """
+        n=min(n, self.count, self.capacity)
+        end=self._head+self.capacity
+        return self._tstamps[end-n:end], self._data[end-n:end]
+
+    def latest(self, seconds):
+        """ Returns views (tstamps, samples) of the samples received in the
+        latest given number of seconds, as measured from the time stamp of
+        the newest sample. """
+        tstamps, samples=self.last(self.capacity)
+        if len(tstamps)==0:
+            return tstamps, samples
+        start=np.searchsorted(tstamps, tstamps[-1]-round(seconds*1e9),
+                              side='right')
+        return tstamps[start:], samples[start:]
+
+    def __len__(self):
+        """ Number of samples currently held """
+        return min(self.count, self.capacity)
+
+
+class BoundedQueue(aio.Queue):
+    """ An asyncio queue of bounded capacity that never blocks or raises
+    when full; instead, put_nowait applies an overflow policy:
+
+    'drop_oldest': the oldest frame in the queue is discarded
+    'drop_newest': the incoming frame is discarded
+    'coalesce':    the incoming frame is merged into the newest frame in 
+                   the queue (samples are concatenated, and the time stamp
+                   of the incoming frame is kept). Frames that cannot be
+                   merged (raw frames, heartbeats unpacked one by one, or
+                   frames of a different measurement) are handled as in
+                   drop_oldest
+
+    Pass a BoundedQueue to HeartRate or PolarMeasurementData in place of a
+    standard queue to bound memory use when the consumer falls behind.
+    """
+    policies=('drop_oldest', 'drop_newest', 'coalesce')
+
+    def __init__(self, maxsize, overflow='drop_oldest'):
+        """ Init the queue.
+
+        Args:
+
+        maxsize:  the capacity of the queue, in frames
+        overflow: the overflow policy, one of BoundedQueue.policies
+
+        Attributes:
+
+        dropped:   the number of frames discarded so far
+        coalesced: the number of frames merged into queued frames so far
+        """
+        if maxsize<=0:
+            raise ValueError("BoundedQueue requires a positive maxsize")
+        if overflow not in self.policies:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        super().__init__(maxsize)
+        self.overflow=overflow
+        self.dropped=0
+        self.coalesced=0
+
+    def put_nowait(self, item):
+        """ Puts item into the queue, applying the overflow policy if the
+        queue is full """
+        if not self.full():
+            return super().put_nowait(item)
+        if self.overflow=='drop_newest':
+            self.dropped+=1
+            return
+        if self.overflow=='coalesce':
+            # self._queue is the deque backing asyncio.Queue
+            merged=_coalesce_frames(self._queue[-1], item)
+            if merged!=None:
+                self._queue[-1]=merged
+                self.coalesced+=1
+                return
+        self.get_nowait()
+        self.task_done()
+        self.dropped+=1
+        super().put_nowait(item)
+
+
+def _concatenate(first, second):
+    """ Concatenates two lists or numpy arrays of samples """
+    if np!=None and isinstance(first, np.ndarray):
+        return np.concatenate((first, second))
+    return list(first)+list(second)
+
+
+def _coalesce_frames(old, new):
+    """ Merges frame new into frame old. Returns the merged frame, or None
+    if the frames cannot be merged. """
+    if old[0]!=new[0] or type(old)!=type(new):
+        return None
+    if isinstance(new, FrameBatch):
+        return FrameBatch(new.measurement,
+                          _concatenate(old.tstamps, new.tstamps),
+                          _concatenate(old.samples, new.samples),
+                          old.counts+new.counts)
+    if new[0]=='HR' and isinstance(new[1], list):
+        # heartbeats of a frame, delivered with per_frame
+        return ('HR', old[1]+new[1], (old[2][0]+new[2][0],
+                                      old[2][1]+new[2][1]), new[3])
+    if new[0]=='HR':
+        # only frames with a list of RR intervals can be merged
+        if not isinstance(new[2][1], list):
+            return None
+        return ('HR', new[1], (new[2][0], old[2][1]+new[2][1]), new[3])
+    if isinstance(new[2], (bytes, bytearray)):
+        return None
+    if np!=None and isinstance(new[1], np.ndarray):
+        # per-sample time stamps
+        return (new[0], _concatenate(old[1], new[1]),
+                _concatenate(old[2], new[2]))
+    return (new[0], new[1], _concatenate(old[2], new[2]))
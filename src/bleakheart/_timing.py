@@ -0,0 +1,155 @@
+"""
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+# numpy is optional; it is required for per-sample time stamps
+try:
+    import numpy as np
+except ImportError:
+    np=None
+
+
+def sample_timestamps(tstamp, previous, count, sample_rate):
+    """ Computes the time stamp of each sample in a frame. PMD frames carry
+    a single time stamp, which refers to the last sample. If the time
+    stamp of the previous frame of the same measurement is known, and
+    consistent with the sampling rate, the samples are spread evenly
+    between the two time stamps; this follows the sensor clock, which may
+    run slightly faster or slower than nominal. Otherwise, samples are
+    spaced by the nominal sampling period.
+
+    Args:
+        tstamp:      time stamp of the last sample of the frame, in ns
+        previous:    time stamp of the last sample of the previous frame,
+                     or None
+        count:       number of samples in the frame
+        sample_rate: nominal sampling rate, in Hz, or None if unknown
+
+    Returns:
+        A numpy int64 array with the time stamp of each sample, in ns
+    """
+    back=np.arange(count-1, -1, -1, dtype=np.float64)
+    if sample_rate:
+        period=1e9/sample_rate
+        # accept the previous frame if no more than half a frame's worth
+        # of samples appear to be missing or in excess
+        if (previous!=None and
+            abs(tstamp-previous-count*period)<=count*period/2):
+            period=(tstamp-previous)/count
+    elif previous!=None and tstamp>previous:
+        period=(tstamp-previous)/count
+    else:
+        period=0
+    return tstamp-np.rint(back*period).astype(np.int64)
+
+
+class ClockSync:
+    """ Maps sensor time to host time, following the drift between the two
+    clocks. Each frame gives an observation of the offset between host and
+    sensor clocks: the host arrival time minus the sensor time stamp. This
+    is the true offset plus a (positive, variable) transmission latency,
+    so the minimum observation over a window of window_s seconds is kept,
+    and the window minima are fitted with a weighted linear regression of
+    offset against sensor time. Older minima are discounted exponentially
+    (their weight halves every halflife_s seconds), so that the fit tracks
+    slow changes in drift. Updates are O(1) per frame.
+
+    Until two windows have been completed, the smallest offset observed so
+    far is used.
+
+    Attributes:
+
+    offset: the current offset estimate in ns (host minus sensor time), or
+            None before the first observation
+    drift:  the current drift estimate in parts per million (positive if
+            the sensor clock runs slow compared to the host), or None
+            before two windows have been completed
+    """
+
+    def __init__(self, window_s=10, halflife_s=1800):
+        """ Init the clock synchroniser.
+
+        Args:
+
+        window_s:   length in seconds of the windows over which the minimum
+                    offset is taken
+        halflife_s: time in seconds after which the weight of a window in
+                    the fit is halved
+        """
+        self.window=round(window_s*1e9)
+        self._decay=0.5**(window_s/halflife_s)
+        self.reset()
+
+    def reset(self):
+        """ Discards all observations, e.g. after a reconnection """
+        self._t0=None     # sensor time of first observation, ns
+        self._last=None   # sensor time of latest observation, ns
+        self._y0=None     # first offset; offsets are fitted relative to it
+        self._win_start=None
+        self._win_min=None
+        self._win_t=None
+        self._best=None   # smallest offset so far, relative to _y0
+        # weighted sums for the regression of y (ns) against x (s)
+        self._s0=self._sx=self._sy=self._sxx=self._sxy=0.0
+        self._points=0
+        self._slope=None
+        self._intercept=None
+
+    def update(self, sensor_ns, host_ns):
+        """ Adds an observation: a frame with sensor time stamp sensor_ns
+        was received at host time host_ns. Returns the sensor time stamp 
+        mapped to host time. """
+        if self._t0==None:
+            self._t0=sensor_ns
+            self._y0=host_ns-sensor_ns
+            self._win_start=sensor_ns
+        self._last=sensor_ns
+        y=host_ns-sensor_ns-self._y0
+        if self._best==None or y<self._best:
+            self._best=y
+        if self._win_min==None or y<self._win_min:
+            self._win_min=y
+            self._win_t=sensor_ns
+        if sensor_ns-self._win_start>=self.window:
+            self._add_point((self._win_t-self._t0)/1e9, self._win_min)
+            self._win_start=sensor_ns
+            self._win_min=None
+        return self.to_host(sensor_ns)
+
+    def _add_point(self, x, y):
+        """ Adds a window minimum to the exponentially weighted fit """
+        d=self._decay
+        self._s0=self._s0*d+1
+        self._sx=self._sx*d+x
+        self._sy=self._sy*d+y
+        self._sxx=self._sxx*d+x*x
+        self._sxy=self._sxy*d+x*y
+        self._points+=1
+        det=self._s0*self._sxx-self._sx*self._sx
+        if self._points>=2 and det>0:
+            self._slope=(self._s0*self._sxy-self._sx*self._sy)/det
+            self._intercept=(self._sy-self._slope*self._sx)/self._s0
+
+    def to_host(self, sensor_ns):
+        """ Maps a sensor time stamp to host time, in ns """
+        if self._slope==None:
+            return sensor_ns+self._y0+self._best
+        x=(sensor_ns-self._t0)/1e9
+        return sensor_ns+self._y0+round(self._intercept+self._slope*x)
+
+    @property
+    def offset(self):
+        """ The current offset estimate (host minus sensor time), in ns """
+        if self._t0==None:
+            return None
+        return self.to_host(self._last)-self._last
+
+    @property
+    def drift(self):
+        """ The current drift estimate, in parts per million """
+        if self._slope==None:
+            return None
+        # slope is in ns per s, i.e. parts per billion
+        return self._slope/1000